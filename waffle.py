@@ -1,13 +1,21 @@
 import argparse
 
-import csv
+import importlib.util
+import mmap
 import os
+import tempfile
+from array import array
 from datetime import datetime
-from collections import defaultdict
-from typing import List, Dict, Tuple, Union, Iterator
+from typing import List, Dict, Tuple, Union, Iterator, Optional, TYPE_CHECKING
 
+import numpy as np
 from matplotlib import pyplot as plt
-from matplotlib.dates import MonthLocator, DateFormatter
+from matplotlib.collections import LineCollection
+from matplotlib.dates import MonthLocator, DateFormatter, date2num
+from matplotlib.lines import Line2D
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 FIRST, LAST = 0, -1
 
@@ -27,16 +35,22 @@ MAX_RANK = int(args.maxrank)
 
 # Output
 FIG_NAME = args.fig
+FIG_BACKEND = "Agg"
 FIG_LOCATION = os.path.join(os.path.dirname(__file__), FIG_NAME)
 FIG_SIZE = (int(args.figsize), int(args.figsize))
 
 # Data source
 WAFFLE_CSV = os.path.join(os.path.dirname(__file__), "waffle.csv")
+CACHE_FILE = os.path.splitext(WAFFLE_CSV)[0] + ".npz"
+CACHE_VERSION = 2
 COL_UID = 0
 COL_WAFFLES = 1
 COL_TIME = 2
 COL_USERNAME = 3
+CSV_COLUMNS = ("uid", "waffles", "time", "username")
+CSV_DTYPES = {"uid": "int32", "waffles": "int32", "time": str, "username": "category"}
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_SLICE = slice(0, 10)
 
 # Plot settings
 DO_GRID = not args.no_grid
@@ -44,12 +58,19 @@ GRID_LINESTYLE = "-."
 
 DO_LEGEND = not args.no_legend
 LEGEND_MAX_ROWS = 12
+LEGEND_MAX_COLUMNS = 10
+LEGEND_LOCATION = "upper left"
 
 DO_TEXTBOXES = bool(args.textboxes)
 TEXTBOX_SIZE = 9
 TEXTBOX_COLOR = "white"
 TEXTBOX_EDGE_COLOR = "black"
 TEXTBOX_ALPHA = 0.5
+TEXTBOX_BBOX = {
+    "facecolor": TEXTBOX_COLOR,
+    "alpha": TEXTBOX_ALPHA,
+    "edgecolor": TEXTBOX_EDGE_COLOR,
+}
 
 LINESTYLE_PRIMARY_THRESHOLD = 25
 LINESTYLE_SECONDARY_THRESHOLD = 50
@@ -63,124 +84,319 @@ COLOR_MAP = 'gist_ncar'
 XAXIS_DATE_FORMAT = "%b '%y"
 XAXIS_TICK_MONTHS = (1, 7)
 
+# Storage
+ARRAY_TYPECODE = "i"  # C int, matching np.intc
+
 # Type hints
-RowList = List[Dict[str, str]]
-DatetimeList = List[datetime]
-CountLookup = Dict[str, int]
-IndexLookup = Dict[str, int]
-History = List[int]
-HistoryLookup = Dict[str, History]
+RowIterator = Iterator[List[bytes]]
+DateArray = np.ndarray
+UserList = List[str]
+IndexArray = np.ndarray
+HistoryMatrix = np.ndarray
+ColorArray = np.ndarray
+VertexMask = np.ndarray
+RowColumns = Tuple[np.ndarray, np.ndarray, np.ndarray]
+WaffleData = Tuple[DateArray, UserList, HistoryMatrix, IndexArray]
 Number = Union[int, float, bool]
 
 
-def read_csv() -> RowList:
-    """Read the csv file and return its list-of-dicts representation."""
-    return list(csv.reader(open(WAFFLE_CSV)))
+def parse_time(time_str: bytes) -> datetime:
+    """Parse a timestamp from the csv file. The timestamps always follow
+    TIME_FORMAT, so the fields are read at fixed offsets instead of going
+    through strptime."""
+    return datetime(
+        int(time_str[0:4]),
+        int(time_str[5:7]),
+        int(time_str[8:10]),
+        int(time_str[11:13]),
+        int(time_str[14:16]),
+        int(time_str[17:19]),
+    )
 
 
-def get_top_users(rows: RowList) -> CountLookup:
-    """Take the input from reading the csv file. The return value is a dict
-    where each key is a username. Each value is the total number of waffles
-    eaten by that person. Only users who have at one point been in the top
-    MAX_RANK waffle eaters are included."""
-    users = defaultdict(int)
+def iter_rows() -> RowIterator:
+    """Read the csv file and return an iterator over its rows. The fields
+    never contain commas or escaped quotes, so the file is memory mapped and
+    split directly instead of going through the csv module."""
+    with open(WAFFLE_CSV, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line in iter(data.readline, b""):
+                yield line.rstrip(b"\r\n").replace(b'"', b"").split(b",", COL_USERNAME)
+
+
+def get_row_columns(rows: RowIterator) -> (List[bytes], List[bytes], RowColumns):
+    """Take the input from reading the csv file and consume it in a single
+    pass. The first return value is a list with the first timestamp of each
+    day. The second return value is a list of usernames in order of first
+    appearance. The third return value holds one array per column: the index
+    of the user, the index of the snapshot the row counts towards (see
+    get_running_totals) and the number of waffles."""
+    user_index: Dict[bytes, int] = {}
+    snapshot_times: List[bytes] = []
     prev_day = None
-    top_users = {}
+
+    # The columns are stored as C ints to avoid an object per value
+    user_ids = array(ARRAY_TYPECODE)
+    snapshot_ids = array(ARRAY_TYPECODE)
+    waffles = array(ARRAY_TYPECODE)
 
     for row in rows:
-        # Add waffles
-        users[row[COL_USERNAME]] += int(row[COL_WAFFLES])
-
-        # Check date
-        consumption_time = datetime.strptime(row[COL_TIME], TIME_FORMAT)
-
-        # If it is a new day, set the new top users
-        if consumption_time.day != prev_day:
-            top_users.update({
-                key: users[key]
-                for key in sorted(users, key=users.get, reverse=True)[:MAX_RANK]
-            })
-        prev_day = consumption_time.day
-
-    return top_users
-
-
-def parse_waffle_rows(rows: RowList) -> (DatetimeList, HistoryLookup):
-    """Take the input from reading the csv file. The first return value is a
-    list of datetimes at which point waffles were consumed. The second return
-    value is a dict where each key is a username. Each value in the second
-    return value is a list of waffle counts for each point in time in the date-
-    time list (the first return value)."""
-    top_users = get_top_users(rows)
-    user_counts = { key: 0 for key in top_users }
-
-    consumption_times: DatetimeList = []
-    history_lookup: HistoryLookup = defaultdict(list)
-    prev_day = None
+        user_ids.append(user_index.setdefault(row[COL_USERNAME], len(user_index)))
+        waffles.append(int(row[COL_WAFFLES]))
+
+        # If it is a new day, the snapshot is taken on this row. Otherwise the
+        # row counts towards the snapshot of the next day.
+        day = row[COL_TIME][DATE_SLICE]
+        if day != prev_day:
+            snapshot_times.append(row[COL_TIME])
+            snapshot_ids.append(len(snapshot_times) - 1)
+        else:
+            snapshot_ids.append(len(snapshot_times))
+        prev_day = day
+
+    columns = (
+        np.frombuffer(user_ids, dtype=np.intc),
+        np.frombuffer(snapshot_ids, dtype=np.intc),
+        np.frombuffer(waffles, dtype=np.intc),
+    )
+    return snapshot_times, list(user_index), columns
+
+
+def get_running_totals(columns: RowColumns, num_users: int, num_days: int) -> (HistoryMatrix, IndexArray):
+    """Take the row columns and return a matrix with one row per user and one
+    column per day, holding the total number of waffles eaten by each user
+    when the snapshot for that day was taken. Each snapshot is taken on the
+    first row of the day, so it includes that row but not the rest of the
+    day. The second return value is the index of the first snapshot each user
+    appears in."""
+    user_ids, snapshot_ids, waffles = columns
+
+    # Rows after the first row of the last day go in an extra column
+    totals = np.zeros((num_users, num_days + 1), dtype=np.int32)
+    np.add.at(totals, (user_ids, snapshot_ids), waffles)
+    counts = totals[:, :num_days].cumsum(axis=1, dtype=np.int32)
+
+    first_seen = np.full(num_users, num_days, dtype=np.int32)
+    np.minimum.at(first_seen, user_ids, snapshot_ids)
+
+    return counts, first_seen
+
+
+def get_top_users(counts: HistoryMatrix, first_seen: IndexArray) -> IndexArray:
+    """Take the running totals. The return value is an array of user indices.
+    Only users who have at one point been in the top MAX_RANK waffle eaters
+    are included, in the order in which they first entered the top."""
+    num_users, num_days = counts.shape
+
+    # Users can not be in the top before their first waffle
+    seen = np.arange(num_days) >= first_seen[:, np.newaxis]
+
+    # Rank the users each day. The sort is stable, so ties are ranked in order
+    # of first appearance.
+    order = np.argsort(np.where(seen, -counts, np.inf), axis=0, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(num_users)[:, np.newaxis], axis=0)
+    in_top = seen & (ranks < MAX_RANK)
+
+    # Keep the users who have been in the top, in the order in which they
+    # first entered it
+    top_index = np.flatnonzero(in_top.any(axis=1))
+    first_day = in_top[top_index].argmax(axis=1)
+    first_rank = ranks[top_index, first_day]
+    return top_index[np.lexsort((first_rank, first_day))]
+
+
+def parse_waffle_rows(rows: RowIterator) -> WaffleData:
+    """Take the input from reading the csv file. The first return value is an
+    array of matplotlib dates at which point waffles were consumed. The second
+    return value is a list of all usernames. The third return value is a
+    matrix with one row per username, where each row holds the waffle counts
+    for that user at each point in time in the date array (the first return
+    value). The fourth return value is the first index in the date array at
+    which each user appears."""
+    snapshot_times, users, columns = get_row_columns(rows)
+    counts, first_seen = get_running_totals(columns, len(users), len(snapshot_times))
+
+    consumption_times: DateArray = date2num([
+        parse_time(time_str) for time_str in snapshot_times
+    ])
+
+    return consumption_times, [user.decode() for user in users], counts, first_seen
+
+
+def read_frame() -> "pd.DataFrame":
+    """Read the csv file into a data frame with the C parser in pandas. Only
+    used if pandas is installed."""
+    import pandas as pd
+
+    # Usernames like "NA" or "null" are real users, not missing values
+    frame = pd.read_csv(
+        WAFFLE_CSV,
+        header=None,
+        names=CSV_COLUMNS,
+        dtype=CSV_DTYPES,
+        na_filter=False,
+    )
+
+    # Convert the timestamps separately, since read_csv only takes an explicit
+    # date format from pandas 2.0
+    frame["time"] = pd.to_datetime(frame["time"], format=TIME_FORMAT, cache=True)
+    return frame
+
 
-    for row in (row for row in rows if row[COL_USERNAME] in top_users):
-        # Add waffles
-        user_counts[row[COL_USERNAME]] += int(row[COL_WAFFLES])
-
-        # Check dates
-        consumption_time = datetime.strptime(row[COL_TIME], TIME_FORMAT)
-
-        # If it is a new day, add line data
-        if consumption_time.day != prev_day:
-            for user, count in user_counts.items():
-                history_lookup[user].append(count)
-            consumption_times.append(consumption_time)
-        prev_day = consumption_time.day
-
-    return consumption_times, history_lookup
-
-
-def get_limiting_waffles(history_lookup: HistoryLookup) -> (IndexLookup, IndexLookup):
-    """Returns a tuple of two dicts with the first and last relevant index in
-    the history_lookup for each user. In each dict, the key is a username and
-    the value is the first (or last) relevant index for that user."""
-    first_waffle: IndexLookup = {}
-    last_waffle: IndexLookup = {}
-
-    for username, history in history_lookup.items():
-        # Run backwards and find the last time the wafflecount changed
-        last_index = len(history)
-        next_wafflecount = history[LAST]
-        for wafflecount in reversed(history):
-            last_index -= 1
-            if wafflecount != next_wafflecount:
-                break
-            next_wafflecount = wafflecount
-        last_waffle[username] = min(last_index + 1, len(history))
-
-        # Run forwards and find the first time the wafflecount changed
-        first_index = 0
-        prev_wafflecount = history[FIRST]
-        for wafflecount in history:
-            if wafflecount != prev_wafflecount:
-                break
-            first_index += 1
-        first_waffle[username] = max(first_index - 1, 0)
+def parse_waffle_frame(frame: "pd.DataFrame") -> WaffleData:
+    """Take the data frame from read_frame and return the same values as
+    parse_waffle_rows, working on whole columns at a time."""
+    import pandas as pd
+
+    # Same snapshots as in get_row_columns
+    day = frame["time"].dt.floor("D")
+    is_first = (day != day.shift()).to_numpy()
+    snapshot_ids = np.cumsum(is_first, dtype=np.int32) - is_first
+    num_days = int(is_first.sum())
+
+    # Number the users in order of first appearance
+    user_ids, users = pd.factorize(frame["username"])
+    assert (user_ids >= 0).all(), "missing usernames would be counted for the wrong user"
+
+    columns = (
+        user_ids.astype(np.int32),
+        snapshot_ids,
+        frame["waffles"].to_numpy(dtype=np.int32),
+    )
+    counts, first_seen = get_running_totals(columns, len(users), num_days)
+
+    consumption_times: DateArray = date2num(frame["time"].to_numpy()[is_first])
+
+    return consumption_times, [str(user) for user in users], counts, first_seen
+
+
+def get_cache_stamp() -> np.ndarray:
+    """Returns the values that must match for the cache to be used: the cache
+    format version and the modification time and size of the csv file."""
+    stat = os.stat(WAFFLE_CSV)
+    return np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def read_cache(stamp: np.ndarray) -> Optional[WaffleData]:
+    """Returns the parsed data from the cache file, or None if there is no
+    cache matching the stamp from get_cache_stamp."""
+    try:
+        with np.load(CACHE_FILE) as cache:
+            if not np.array_equal(cache["stamp"], stamp):
+                return None
+            return (
+                cache["consumption_times"],
+                cache["users"].tolist(),
+                cache["counts"],
+                cache["first_seen"],
+            )
+    except Exception:
+        # A missing, truncated or otherwise corrupt cache can fail in many
+        # ways (OSError, EOFError, zipfile.BadZipFile, errors from parsing
+        # the array headers, ...). In every case the csv is parsed again.
+        return None
+
+
+def write_cache(data: WaffleData, stamp: np.ndarray):
+    """Store the parsed data in the cache file, along with the stamp from
+    get_cache_stamp taken before the csv was parsed. The plot can still be
+    made if this fails, so errors are ignored. The data is written to a
+    temporary file which then replaces the cache file, so an interrupted
+    write never leaves a partial cache behind."""
+    consumption_times, users, counts, first_seen = data
+    temp_name = None
+    try:
+        fd, temp_name = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(CACHE_FILE))
+        with os.fdopen(fd, "wb") as file:
+            np.savez(
+                file,
+                stamp=stamp,
+                consumption_times=consumption_times,
+                users=np.array(users, dtype=str),
+                counts=counts,
+                first_seen=first_seen,
+            )
+        # mkstemp makes the file owner-only, so give it the mode a normally
+        # created file would get
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_name, 0o666 & ~umask)
+        os.replace(temp_name, CACHE_FILE)
+    except OSError:
+        if temp_name is not None and os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def load_waffle_data() -> WaffleData:
+    """Returns the parsed data from the cache if it is up to date. Otherwise
+    the csv file is parsed, with pandas if it is installed, and the result is
+    cached for the next run. pandas is slow to import, so it is only imported
+    when the cache can not be used."""
+    # Stamp the csv before parsing it, so that a csv replaced during the parse
+    # does not get the old data cached as up to date
+    stamp = get_cache_stamp()
+    data = read_cache(stamp)
+    if data is None:
+        if importlib.util.find_spec("pandas") is None:
+            data = parse_waffle_rows(iter_rows())
+        else:
+            data = parse_waffle_frame(read_frame())
+        write_cache(data, stamp)
+    return data
+
+
+def get_limiting_waffles(histories: HistoryMatrix) -> (IndexArray, IndexArray):
+    """Returns a tuple of two arrays with the first and last relevant index in
+    the histories for each user. Each array has one element per row in the
+    histories, holding the first (or last) relevant index for that user."""
+    num_days = histories.shape[1]
+
+    # Whether the wafflecount changes after each day. The histories are not
+    # monotone since waffles can be taken back, so they can not be bisected.
+    changed = np.diff(histories, axis=1, append=histories[:, [LAST]]) != 0
+    any_changed = changed.any(axis=1)
+
+    # Find the first time the wafflecount changed
+    first_index = np.where(any_changed, changed.argmax(axis=1) + 1, num_days)
+    first_waffle = np.maximum(first_index - 1, 0)
+
+    # Find the last time the wafflecount changed
+    last_index = np.where(any_changed, num_days - 1 - changed[:, ::-1].argmax(axis=1), 0)
+    last_waffle = np.minimum(last_index + 1, num_days)
 
     return first_waffle, last_waffle
 
 
-def get_color_cycle(num_users: int) -> Iterator[List[Tuple[float]]]:
-    """Generates colors in a way that is compatible with set_prop_cycle.
+def get_line_vertices(histories: HistoryMatrix, first_waffle: IndexArray, last_waffle: IndexArray) -> VertexMask:
+    """Returns a boolean matrix with the same shape as the histories, which is
+    True for the points that are needed to draw each line from its first to
+    its last relevant index. Points in the middle of a run of equal
+    wafflecounts lie on a horizontal line between their neighbours, so they
+    are left out."""
+    changed = histories[:, 1:] != histories[:, :-1]
+    vertices = np.ones(histories.shape, dtype=bool)
+    vertices[:, 1:-1] = changed[:, :-1] | changed[:, 1:]
+
+    # Always keep the ends of the line
+    rows = np.arange(len(histories))
+    vertices[rows, first_waffle] = True
+    vertices[rows, last_waffle - 1] = True
+
+    return vertices
+
+
+def get_colors(num_users: int) -> ColorArray:
+    """Returns an array with one RGBA color per user.
 
     It will cycle through colors multiple times if there are many users (since
     the linestyles will also change)
     """
-    color_map = plt.get_cmap(COLOR_MAP)
-    for index in range(num_users):
-        yield color_map(
-            1.
-            * index
-            * (2 if num_users > LINESTYLE_PRIMARY_THRESHOLD else 1)
-            * (2 if num_users > LINESTYLE_SECONDARY_THRESHOLD else 1)
-            / num_users
-            % 1
-        )
+    cycles = (
+        (2 if num_users > LINESTYLE_PRIMARY_THRESHOLD else 1)
+        * (2 if num_users > LINESTYLE_SECONDARY_THRESHOLD else 1)
+    )
+    return plt.get_cmap(COLOR_MAP)(np.arange(num_users) * cycles / num_users % 1)
 
 
 def get_linestyle_cycle(num_users: int) -> Iterator[str]:
@@ -188,62 +404,74 @@ def get_linestyle_cycle(num_users: int) -> Iterator[str]:
 
     It will yield more varied linestyles if there are many users.
     """
+    primary = num_users > LINESTYLE_PRIMARY_THRESHOLD
+    secondary = num_users > LINESTYLE_SECONDARY_THRESHOLD
+
+    # Few users all get the same linestyle
+    if not primary:
+        yield from [LINESTYLE_FOURTH_QUARTER] * num_users
+        return
+
+    first_quarter = num_users // 4
+    second_quarter = num_users // 2
+    third_quarter = 3 * num_users // 4
     for index in range(num_users):
-        if index < num_users // 4 and num_users > LINESTYLE_SECONDARY_THRESHOLD:
+        if secondary and index < first_quarter:
             yield LINESTYLE_FIRST_QUARTER
-        elif index < num_users // 2 and num_users > LINESTYLE_PRIMARY_THRESHOLD:
+        elif index < second_quarter:
             yield LINESTYLE_SECOND_QUARTER
-        elif index < 3 * num_users // 4 and num_users > LINESTYLE_SECONDARY_THRESHOLD:
+        elif secondary and index < third_quarter:
             yield LINESTYLE_THIRD_QUARTER
         else:
             yield LINESTYLE_FOURTH_QUARTER
 
 
-def do_plot(consumption_times: DatetimeList, history_lookup: HistoryLookup):
+def do_plot(consumption_times: DateArray, usernames: UserList, histories: HistoryMatrix):
     """Make a plot with the data"""
     # Figure out when people started and stopped eating waffles
-    first_waffle, last_waffle = get_limiting_waffles(history_lookup)
+    first_waffle, last_waffle = get_limiting_waffles(histories)
 
-    # Set up the figure
+    # Set up the figure. When saving to a file there is no window to show, so
+    # use a non-interactive backend and skip loading a GUI toolkit.
+    if FIG_NAME:
+        plt.switch_backend(FIG_BACKEND)
     fig = plt.figure(figsize=FIG_SIZE)
     ax = fig.add_subplot(111)
 
     # Set up colors and linestyles in a way that makes sense depending on the
     # number of users
-    num_users = len(history_lookup)
-    ax.set_prop_cycle(
-        linestyle=get_linestyle_cycle(num_users),
-        color=get_color_cycle(num_users),
-    )
-
-    # Plot every history
-    for index, (username, history) in enumerate(history_lookup.items()):
-        # Plot line
-        history_slice = slice(first_waffle[username], last_waffle[username])
-        ax.plot(
-            consumption_times[history_slice],
-            history[history_slice],
-            label=username,
-            linewidth=LINEWIDTH,
-        )
-
-        if DO_TEXTBOXES:
+    num_users = len(usernames)
+    colors = get_colors(num_users)
+    linestyles = list(get_linestyle_cycle(num_users))
+
+    # Plot every history as a single collection of lines
+    vertices = get_line_vertices(histories, first_waffle, last_waffle)
+    segments = [
+        np.column_stack([
+            consumption_times[first:last][keep[first:last]],
+            history[first:last][keep[first:last]],
+        ])
+        for history, keep, first, last in zip(histories, vertices, first_waffle, last_waffle)
+    ]
+    ax.add_collection(LineCollection(
+        segments,
+        colors=colors,
+        linestyles=linestyles,
+        linewidths=LINEWIDTH,
+    ))
+    ax.xaxis_date()
+
+    if DO_TEXTBOXES:
+        for username, history, last in zip(usernames, histories, last_waffle):
             # Add text box at the end of the line
-            txt = ax.text(
-                consumption_times[last_waffle[username]-1],
-                history[last_waffle[username]-1],
-                f"{username}={history_lookup[username][LAST]}",
+            ax.text(
+                consumption_times[last - 1],
+                history[last - 1],
+                f"{username}={history[LAST]}",
                 fontsize=TEXTBOX_SIZE,
-                backgroundcolor=TEXTBOX_COLOR
+                bbox=TEXTBOX_BBOX,
             )
 
-            # Stylize the text box
-            txt.set_bbox({
-                "facecolor": TEXTBOX_COLOR,
-                "alpha": TEXTBOX_ALPHA,
-                "edgecolor": TEXTBOX_EDGE_COLOR,
-            })
-
     # Set up x axis to show dates
     ax.xaxis.set_major_locator(MonthLocator(XAXIS_TICK_MONTHS, bymonthday=1))
     ax.xaxis.set_major_formatter(DateFormatter(XAXIS_DATE_FORMAT))
@@ -252,16 +480,22 @@ def do_plot(consumption_times: DatetimeList, history_lookup: HistoryLookup):
     ax.yaxis.tick_right()
 
     # Zoom in on the data
-    ax.set_ylim(0, max([history[LAST] for history in history_lookup.values()]))
+    ax.set_ylim(0, int(histories[:, LAST].max()))
     ax.set_xlim(consumption_times[FIRST], consumption_times[LAST])
 
     # Add grid
     if DO_GRID:
         ax.grid(linestyle=GRID_LINESTYLE)
 
-    # Add legend
-    if DO_LEGEND:
-        ax.legend(ncol=num_users // LEGEND_MAX_ROWS, handleheight=1)
+    # Add legend, unless there are so many users that it would not fit
+    num_columns = max(num_users // LEGEND_MAX_ROWS, 1)
+    if DO_LEGEND and num_columns <= LEGEND_MAX_COLUMNS:
+        # The collection has no per-line labels, so use proxy artists
+        handles = [
+            Line2D([], [], color=color, linestyle=linestyle, linewidth=LINEWIDTH, label=username)
+            for username, color, linestyle in zip(usernames, colors, linestyles)
+        ]
+        ax.legend(handles=handles, ncol=num_columns, handleheight=1, loc=LEGEND_LOCATION)
 
     # Save or display figure
     if FIG_NAME:
@@ -272,7 +506,9 @@ def do_plot(consumption_times: DatetimeList, history_lookup: HistoryLookup):
 
 def do_it():
     """Read data, parse it and make a plot"""
-    do_plot(*parse_waffle_rows(read_csv()))
+    consumption_times, users, counts, first_seen = load_waffle_data()
+    top_index = get_top_users(counts, first_seen)
+    do_plot(consumption_times, [users[index] for index in top_index], counts[top_index])
 
 
 if __name__ == "__main__":